@@ -0,0 +1,42 @@
+import argparse
+import sys
+
+from tdf_data_bridge.ride_log_format import BINARY_RECORD
+
+
+def read_binary_log(path):
+    """
+    Reads a binary ride log written by RideLogger(binary=True).
+
+    Args:
+        path (str): Path to the .bin log file.
+
+    Returns:
+        list[tuple]: (timestamp, power, cadence, speed, incline) rows, with incline back in percent.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    size = BINARY_RECORD.size
+    usable = len(data) - len(data) % size  # Ignore a partial record left by an interrupted write
+    return [
+        (timestamp, power, cadence, speed, incline / 10.0)
+        for timestamp, power, cadence, speed, incline in BINARY_RECORD.iter_unpack(data[:usable])
+    ]
+
+
+def main():
+    """
+    Prints a binary ride log as CSV, matching the columns of the text ride log.
+    """
+    parser = argparse.ArgumentParser(description="Convert a binary TDF ride log to CSV")
+    parser.add_argument("path", help="Path to ride_log.bin")
+    args = parser.parse_args()
+
+    out = sys.stdout
+    out.write("timestamp,power,cadence,speed,incline\n")
+    for timestamp, power, cadence, speed, incline in read_binary_log(args.path):
+        out.write(f"{timestamp},{power},{cadence},{speed:.1f},{incline:g}\n")
+
+
+if __name__ == "__main__":
+    main()
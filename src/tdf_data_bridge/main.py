@@ -1,20 +1,29 @@
 import serial
 import argparse
+import atexit
 import logging
 import time
-import csv
 import os
+import glob
 from openant.easy.node import Node
 from openant.easy.channel import Channel
 import serial.tools.list_ports
 import asyncio
 import random
 import platform
-from security_utils import (
+import signal
+from functools import lru_cache
+import queue
+import struct
+import threading
+from tdf_data_bridge.ride_log_format import BINARY_RECORD
+from tdf_data_bridge.security_utils import (
     is_authorized_mac,
     is_valid_opcode,
     is_throttled,
     init_security_config,
+    get_config,
+    check,
 )
 
 try:
@@ -24,161 +33,451 @@ try:
 except ImportError:
     BleakServer = None
 
+logger = logging.getLogger(__name__)
+
 FE_C_DEVICE_TYPE = 17
 
+# ANT+ FE-C frame fields: signed raw grade (bytes 5-6), power (bytes 7-8), cadence (byte 10)
+_FEC_FRAME = struct.Struct("<5xhHxB")
+
+# FTMS notify frame: constant flags, then speed, cadence, power, incline, resistance, then front and rear gear
+# bytes copied straight from BikeController.current_gear
+_FTMS_FLAGS = 0b0000001111111111
+_FTMS_FIELDS = struct.Struct("<HHHhH")
+_FTMS_GEAR_OFFSET = 2 + _FTMS_FIELDS.size
+_FTMS_FRAME_SIZE = _FTMS_GEAR_OFFSET + 2
+
 CONFIG_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../config.json"))
 
+# Serial command templates, formatted directly as bytes
+_INCLINE_CMD = b"G%c%02d\r\n"
+_RESISTANCE_CMD = b"R%02d\r\n"
+_GEAR_CMD = b"G%d%d\r\n"
+
+# Every valid incline (-10..20) and every two-digit resistance level (0..99), encoded once at import
+_INCLINE_CMDS = {g: _INCLINE_CMD % (b"+" if g >= 0 else b"-", abs(g)) for g in range(-10, 21)}
+_RESISTANCE_CMDS = {r: _RESISTANCE_CMD % r for r in range(0, 100)}
+
+# Serial settings; the short write timeout keeps a wedged adapter from holding the write lock.
+# A timed-out write only resets the dedup state; the port stays open
+_BAUD_RATE = 115200
+_WRITE_TIMEOUT = 0.05
+
+# Skips access-time updates on the ride log where supported (Linux)
+_O_NOATIME = getattr(os, "O_NOATIME", 0)
+# Keeps os.open() from defaulting to text mode on Windows, where \n would be rewritten on write
+_O_BINARY = getattr(os, "O_BINARY", 0)
+
+# Ride log header; rows use the same \r\n terminator csv.writer produced for existing logs
+_CSV_HEADER = "timestamp,power,cadence,speed,incline\r\n"
+
+# Queue marker telling BikeController's writer to send the latest pending incline
+_INCLINE_PENDING = object()
+
+# FTMS control point opcodes handled by BikeController.handle_control_command
+_OP_SET_RESISTANCE = 0x30
+_OP_SET_GEAR = 0x40
+
+# Cadence (rpm) to speed (km/h) for the fixed 2.5 gear ratio: 2.5 * 3.6 / 60
+_SPEED_FACTOR = 2.5 * 3.6 / 60.0
+
+# Grade mapping: descents are softened, grades above _STEEP_GRADE are compressed
+_DESCENT_SCALE = 0.5
+_STEEP_GRADE = 10
+_STEEP_SCALE = 0.3
+
+# Substrings identifying the bike's CP210x USB-serial adapter
+_SERIAL_PORT_MATCH = ("SLAB", "CP210")
+# On Linux the cp210x driver lists its bound ttys here, so one readdir replaces a full comports() walk
+_CP210X_SYSFS_GLOB = "/sys/bus/usb-serial/drivers/cp210x/tty*"
+
+
+def auto_detect_serial_port():
+    """
+    Scans the system serial ports for the bike's USB adapter. A found port is cached;
+    call invalidate_serial_port_cache() after a hotplug to force a rescan. A miss is not
+    cached, so the next call scans again.
+    """
+    port = _scan_serial_port()
+    if port is None:
+        _scan_serial_port.cache_clear()
+    return port
+
+
+@lru_cache(maxsize=1)
+def _scan_serial_port():
+    """
+    Does the actual scan for auto_detect_serial_port().
+    On Linux the cp210x driver's sysfs directory is checked first, falling back to a full scan.
+    """
+    if platform.system() == "Linux":
+        bound = sorted(glob.glob(_CP210X_SYSFS_GLOB))
+        if bound:
+            device = "/dev/" + os.path.basename(bound[0])
+            logger.info("[BikeController] Auto-detected serial port: %s", device)
+            return device
+    for port in serial.tools.list_ports.comports():
+        if any(match in port.description for match in _SERIAL_PORT_MATCH):
+            logger.info("[BikeController] Auto-detected serial port: %s", port.device)
+            return port.device
+    logger.warning("[BikeController] No compatible serial port detected.")
+    return None
+
+
+def invalidate_serial_port_cache():
+    """
+    Forgets the cached auto-detected serial port.
+    """
+    _scan_serial_port.cache_clear()
+
+
+def _map_grade(percent_grade):
+    """
+    Custom logic to scale very steep grades for realism.
+    """
+    if percent_grade < 0:
+        return percent_grade * _DESCENT_SCALE
+    elif percent_grade > _STEEP_GRADE:
+        return _STEEP_GRADE + (percent_grade - _STEEP_GRADE) * _STEEP_SCALE
+    else:
+        return percent_grade
+
+
+def _incline_from_raw_grade(raw_grade):
+    """
+    Maps a raw FE-C grade (0.01 % units) to the bike's clamped integer incline.
+    """
+    return min(20, max(-10, int(round(_map_grade(raw_grade / 100.0)))))
+
+
+# Raw grade -> incline lookup table, built once at import. Outside this span the
+# incline is already clamped (-10 below -20 %, 20 above ~41.7 %), so callers clamp
+# the index instead of the result.
+_GRADE_LUT_MIN = -2000
+_GRADE_LUT_MAX = 4200
+_INCLINE_LUT = tuple(_incline_from_raw_grade(raw) for raw in range(_GRADE_LUT_MIN, _GRADE_LUT_MAX + 1))
+
 
 class BikeController:
     """
     Handles serial communication with the ProForm TDF bike for incline, resistance, and gear control.
+    Commands are queued by the send_* methods and written by a background thread, so callers on the
+    event loop or in BLE callbacks never block on the tty. Incline updates are latest-wins: while one
+    is waiting to be written, newer grades replace it instead of queueing behind it. Commands that arrive
+    together (e.g. a burst of BLE control writes) are joined into a single serial write.
     """
 
+    TX_QUEUE_SIZE = 8
+    COALESCE_SECONDS = 0.002  # How long the writer waits for more commands before writing a batch
+
     def __init__(self, port=None):
+        self._detected = port is None
+        self._redetect = False  # Set after a serial error on an auto-detected port
         self.port = port or self.auto_detect_serial_port()
         self.last_sent_incline = None
+        self.last_sent_resistance = None
+        self.last_sent_gear = None
+        # Selected (front, rear) gear, mutated in place so SensorDataProcessor can share it
+        self.current_gear = bytearray(b"\x01\x01")
+        self._ser = None
+        self._lock = threading.Lock()
+        self._pending_incline = None
+        self._pending_lock = threading.Lock()
+        self._tx_queue = queue.Queue(maxsize=self.TX_QUEUE_SIZE)
+        self._writer = threading.Thread(target=self._drain, name="bike-serial", daemon=True)
+        self._writer.start()
 
     def auto_detect_serial_port(self):
         """
         Automatically detects the serial port connected to the bike.
         """
-        ports = serial.tools.list_ports.comports()
-        for port in ports:
-            if "SLAB" in port.description or "CP210" in port.description:
-                logging.info(f"[BikeController] Auto-detected serial port: {port.device}")
-                return port.device
-        logging.warning("[BikeController] No compatible serial port detected.")
-        return None
+        return auto_detect_serial_port()
 
     def send_incline(self, grade):
         """
         Sends incline grade to the bike using ASCII protocol.
+        Grades that round to the last sent value are skipped, since they would produce identical bytes.
         """
-        if self.port is None or not (-10 <= grade <= 20):
+        rounded = int(round(grade))
+        # Most calls repeat the current grade, so test that first
+        if rounded == self.last_sent_incline:
             return
-        if self.last_sent_incline is not None and abs(grade - self.last_sent_incline) < 1:
+        if self.port is None or not (-10 <= grade <= 20):
             return
-        self.last_sent_incline = grade
-        sign = '+' if grade >= 0 else '-'
-        value = f"{abs(int(round(grade))):02d}"
-        cmd = f"G{sign}{value}\r\n".encode("ascii")
-        self._write_to_bike(cmd, "[Incline]")
+        self.last_sent_incline = rounded
+        cmd = _INCLINE_CMDS[rounded]
+        with self._pending_lock:
+            queued = self._pending_incline is not None
+            self._pending_incline = cmd
+        # Only the first pending grade needs a queue slot; later ones just replace the command in it
+        if not queued and not self._enqueue(_INCLINE_PENDING):
+            with self._pending_lock:
+                # A newer grade may have replaced ours meanwhile; it would be lost with the slot, so leave it
+                if self._pending_incline is cmd:
+                    self._pending_incline = None
+            self.last_sent_incline = None
 
     def send_resistance(self, level):
         """
-        Sends resistance level to the bike (e.g., for ERG mode).
+        Sends resistance level to the bike (e.g., for ERG mode). Repeats of the last level are skipped.
         """
-        if self.port is None:
+        if level == self.last_sent_resistance or self.port is None:
             return
-        cmd = f"R{level:02d}\r\n".encode("ascii")
-        self._write_to_bike(cmd, "[Resistance]")
+        self.last_sent_resistance = level
+        cmd = _RESISTANCE_CMDS.get(level) or _RESISTANCE_CMD % level
+        if not self._enqueue((cmd, "[Resistance]")):
+            self.last_sent_resistance = None
 
     def send_gear(self, front, rear):
         """
-        Simulates a gear shift by sending front and rear gear values.
+        Simulates a gear shift by sending front and rear gear values. Repeats of the last gear pair are skipped.
+        current_gear only changes once the command is queued, so it never reports a gear the bike wasn't sent.
         """
-        if self.port is None:
+        if (front, rear) == self.last_sent_gear or self.port is None:
             return
-        cmd = f"G{front}{rear}\r\n".encode("ascii")
-        self._write_to_bike(cmd, "[Gear]")
+        self.last_sent_gear = (front, rear)
+        cmd = _GEAR_CMD % (front, rear)
+        if not self._enqueue((cmd, "[Gear]")):
+            self.last_sent_gear = None
+            return
+        gear = self.current_gear
+        gear[0] = front
+        gear[1] = rear
+
+    def handle_control_command(self, opcode, param, tail=b""):
+        """
+        Applies a validated BLE control point command.
+        Resistance takes the level in param; gear takes the front gear in param and the rear gear in tail[0].
+        """
+        if opcode == _OP_SET_RESISTANCE:
+            self.send_resistance(param)
+        elif opcode == _OP_SET_GEAR:
+            if not tail:
+                logger.warning("[BikeController] Gear command missing rear gear")
+                return
+            self.send_gear(param, tail[0])
+        else:
+            logger.debug("[BikeController] Unsupported control opcode: %s", opcode)
+
+    def _enqueue(self, item):
+        """
+        Hands a command to the writer thread without blocking. Returns False if the queue is full
+        and the command was dropped, so the caller can let the next identical command through.
+        """
+        try:
+            self._tx_queue.put_nowait(item)
+            return True
+        except queue.Full:
+            logger.warning("[BikeController] Serial queue full, dropping command")
+            return False
+
+    def _drain(self):
+        """
+        Background loop writing queued commands until the None sentinel is received.
+        After each wake-up it briefly collects whatever else is queued and sends it all in one write.
+        """
+        while True:
+            items = [self._tx_queue.get()]
+            if items[0] is not None:
+                time.sleep(self.COALESCE_SECONDS)
+                try:
+                    while len(items) < self.TX_QUEUE_SIZE and items[-1] is not None:
+                        items.append(self._tx_queue.get_nowait())
+                except queue.Empty:
+                    pass
+            try:
+                commands = []
+                labels = []
+                for item in items:
+                    if item is _INCLINE_PENDING:
+                        with self._pending_lock:
+                            command, self._pending_incline = self._pending_incline, None
+                        item = (command, "[Incline]")
+                    if item is not None and item[0] is not None:
+                        commands.append(item[0])
+                        labels.append(item[1])
+                # An incline left in the slot without a marker (its enqueue lost a full-queue race) goes out too
+                with self._pending_lock:
+                    command, self._pending_incline = self._pending_incline, None
+                if command is not None:
+                    commands.append(command)
+                    labels.append("[Incline]")
+                if commands:
+                    self._write_to_bike(b"".join(commands), "".join(labels))
+            finally:
+                for _ in items:
+                    self._tx_queue.task_done()
+            if items[-1] is None:
+                return
+
+    def flush(self):
+        """
+        Blocks until every queued command has been written (or has failed).
+        """
+        self._tx_queue.join()
 
     def _write_to_bike(self, command, label=""):
         """
         Internal helper to write a command to the bike's serial port.
+        The port is opened on first use and kept open; on error it is closed so the next call reopens it.
+        An auto-detected port is looked up again before that reopen, keeping the old one if nothing is found.
+        """
+        with self._lock:
+            try:
+                if self._ser is None:
+                    if self._redetect:
+                        # The adapter may have been re-plugged under a new device name
+                        self.port = self.auto_detect_serial_port() or self.port
+                        self._redetect = False
+                    self._ser = serial.Serial(
+                        self.port, _BAUD_RATE, timeout=1, write_timeout=_WRITE_TIMEOUT, exclusive=True
+                    )
+                    self._enable_low_latency()
+                self._ser.write(command)
+                logger.debug("%s Sent: %r", label, command)
+            except serial.SerialTimeoutException as e:
+                # A slow write isn't a dead port; keep it open and let the next command of each kind through
+                logger.warning("%s Serial write timed out: %s", label, e)
+                self.last_sent_incline = self.last_sent_resistance = self.last_sent_gear = None
+            except serial.SerialException as e:
+                logger.error("%s Serial error: %s", label, e)
+                self._close_port()
+                # Nothing is known to have reached the bike, so let the next command of each kind through
+                self.last_sent_incline = self.last_sent_resistance = self.last_sent_gear = None
+                if self._detected:
+                    invalidate_serial_port_cache()
+                    self._redetect = True
+
+    def _enable_low_latency(self):
+        """
+        Asks the tty driver to push writes out immediately (ASYNC_LOW_LATENCY) where pyserial supports it.
+        Caller must hold the lock.
         """
         try:
-            with serial.Serial(self.port, 115200, timeout=1, exclusive=True) as ser:
-                ser.write(command)
-                logging.debug(f"{label} Sent: {command}")
-        except serial.SerialException as e:
-            logging.error(f"{label} Serial error: {e}")
+            self._ser.set_low_latency_mode(True)
+        except (NotImplementedError, ValueError, AttributeError) as e:
+            logger.debug("[BikeController] Low-latency mode unavailable: %s", e)
+
+    def _close_port(self):
+        """
+        Closes the serial port if open. Caller must hold the lock.
+        """
+        if self._ser is not None:
+            try:
+                self._ser.close()
+            except serial.SerialException as e:
+                logger.error("[BikeController] Failed to close serial port: %s", e)
+            self._ser = None
+
+    def close(self):
+        """
+        Writes any queued commands, stops the writer thread and closes the serial connection.
+        Safe to call more than once.
+        """
+        if self._writer.is_alive():
+            self._tx_queue.put(None)
+            self._writer.join()
+        with self._lock:
+            self._close_port()
 
 
 class SensorDataProcessor:
     """
-    Processes incoming ANT+ data, logs metrics, updates BLE clients, and commands the bike.
+    Processes incoming ANT+ data, logs metrics through a RideLogger, updates BLE clients, and commands the bike.
     """
 
-    def __init__(self, bike_controller, log_file="ride_log.csv", ble_characteristic=None):
+    NOTIFY_INTERVAL = 1.0  # FTMS clients treat silence as a dropout, so renotify at least this often (seconds)
+
+    def __init__(self, bike_controller, ride_logger, ble_characteristic=None):
         self.bike = bike_controller
-        self.log_file = log_file
+        self.ride_logger = ride_logger
         self.ble_characteristic = ble_characteristic
         self.current_resistance = 10
         self.current_incline = 0.0
-        self.current_gear = (1, 1)
+        self.current_gear = bike_controller.current_gear  # Shared with the bike, so BLE gear shifts show up here
+        self._notified_gear = None
+        self._notified_at = 0.0
+        # Reused for every notification; the flags never change so they are written once here
+        self._notify_buf = bytearray(_FTMS_FRAME_SIZE)
+        struct.pack_into("<H", self._notify_buf, 0, _FTMS_FLAGS)
 
-        # Create log file with header if it doesn't exist
-        if not os.path.exists(log_file):
-            with open(log_file, "w", newline="") as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow(["timestamp", "power", "cadence", "speed", "incline"])
+    def estimate_speed_from_cadence(self, cadence):
+        """
+        Convert cadence (rpm) to estimated speed in km/h. Rounding is left to the log writers.
+        """
+        return cadence * _SPEED_FACTOR
 
-    def estimate_speed_from_cadence(self, cadence, gear_ratio=2.5):
+    @property
+    def ble_characteristic(self):
+        return self._ble_characteristic
+
+    @ble_characteristic.setter
+    def ble_characteristic(self, characteristic):
         """
-        Convert cadence (rpm) to estimated speed in km/h.
+        Attaches the FTMS notify characteristic and decides once whether it can notify,
+        so _notify_ble doesn't re-inspect its properties on every packet.
         """
-        return round(cadence * gear_ratio / 60.0 * 3.6, 1)
+        self._ble_characteristic = characteristic
+        self._notify_enabled = bool(characteristic and "notify" in (characteristic.properties or ()))
+        self._notified = None  # Force a notification for the new characteristic
 
     def process(self, data):
         """
-        Main method called on each ANT+ data packet.
+        Main method called on each ANT+ data packet, on the event loop.
         Parses and logs metrics, controls the bike, and sends BLE updates.
+        Incline commands are only queued here; BikeController's writer thread does the serial I/O.
+        Every packet is logged. A packet that repeats the last one isn't sent to the bike, and is only
+        re-notified once NOTIFY_INTERVAL has passed since the last notification.
         """
-        power = data[7] | (data[8] << 8)
-        cadence = data[10]
-        speed = self.estimate_speed_from_cadence(cadence)
+        raw_grade, power, cadence = _FEC_FRAME.unpack_from(data)
+        speed = cadence * _SPEED_FACTOR  # estimate_speed_from_cadence, inlined for the per-packet path
 
-        raw_grade = data[5] | (data[6] << 8)
-        percent_grade = raw_grade / 100.0
-        mapped_grade = self._map_grade(percent_grade)
-        incline = max(-10, min(20, int(round(mapped_grade))))
+        incline = _INCLINE_LUT[min(max(raw_grade, _GRADE_LUT_MIN), _GRADE_LUT_MAX) - _GRADE_LUT_MIN]
         self.current_incline = incline
 
-        logging.info(f"Power: {power} W, Cadence: {cadence} rpm, Speed: {speed} kph, Incline: {incline}%")
-
-        self._log_to_csv(power, cadence, speed, incline)
-        self.bike.send_incline(incline)
-        self._notify_ble(power, cadence, speed, incline)
-
-    def _map_grade(self, percent_grade):
-        """
-        Custom logic to scale very steep grades for realism.
-        """
-        if percent_grade < 0:
-            return percent_grade * 0.5
-        elif percent_grade > 10:
-            return 10 + (percent_grade - 10) * 0.3
-        else:
-            return percent_grade
-
-    def _log_to_csv(self, power, cadence, speed, incline):
-        """
-        Appends data to the ride log CSV.
-        """
-        with open(self.log_file, "a", newline="") as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow([time.time(), power, cadence, speed, incline])
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Power: %d W, Cadence: %d rpm, Speed: %.1f kph, Incline: %d%%", power, cadence, speed, incline)
+
+        self.ride_logger.log(power, cadence, speed, incline)
+        if incline != self.bike.last_sent_incline:
+            self.bike.send_incline(incline)
+        # Speed derives from cadence, so these plus the gear cover everything in the FTMS frame
+        state = (power, cadence, incline, self.current_resistance)
+        now = time.monotonic()
+        if (
+            state != self._notified
+            or self.current_gear != self._notified_gear
+            or now - self._notified_at >= self.NOTIFY_INTERVAL
+        ):
+            self._notified = state
+            self._notified_gear = bytes(self.current_gear)
+            self._notified_at = now
+            self._notify_ble(power, cadence, speed, incline)
 
     def _notify_ble(self, power, cadence, speed, incline):
         """
         Sends FTMS-compliant BLE notification to clients.
         """
-        if self.ble_characteristic and self.ble_characteristic.properties and "notify" in self.ble_characteristic.properties:
+        if self._notify_enabled:
+            characteristic = self._ble_characteristic
             try:
-                flags = 0b0000001111111111
-                notify_data = bytearray()
-                notify_data.append(flags & 0xFF)
-                notify_data.append((flags >> 8) & 0xFF)
-                notify_data += int(speed * 100).to_bytes(2, byteorder='little')
-                notify_data += int(cadence * 2).to_bytes(2, byteorder='little')
-                notify_data += int(power).to_bytes(2, byteorder='little')
-                notify_data += int(incline * 10).to_bytes(2, byteorder='little', signed=True)
-                notify_data += int(self.current_resistance).to_bytes(2, byteorder='little')
-                notify_data += bytes(self.current_gear)
-                self.ble_characteristic.value = notify_data
-                logging.debug(f"[BLE Notify FTMS] Sent: {list(notify_data)}")
+                notify_data = self._notify_buf
+                _FTMS_FIELDS.pack_into(
+                    notify_data,
+                    2,
+                    int(speed * 100),
+                    int(cadence * 2),
+                    int(power),
+                    int(incline * 10),
+                    int(self.current_resistance),
+                )
+                notify_data[_FTMS_GEAR_OFFSET:] = self.current_gear
+                # Hand the BLE stack its own copy; the buffer is repacked on the next packet
+                characteristic.value = bytes(notify_data)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("[BLE Notify FTMS] Sent: %s", list(notify_data))
             except Exception as e:
-                logging.error(f"[BLE Notify] Failed to send: {e}")
+                logger.error("[BLE Notify] Failed to send: %s", e)
 
 
 class BLEServiceManager:
@@ -189,22 +488,31 @@ class BLEServiceManager:
     def __init__(self, bike_controller, security_checker):
         self.bike = bike_controller
         self.security = security_checker
+        self._check = security_checker.check  # Bound once; called on every BLE write
         self.ble_characteristic = None
         self.control_point_characteristic = None
 
-    async def start(self):
+    @staticmethod
+    def is_supported():
         """
-        Initializes the BLE FTMS service and starts advertising (simulated).
+        Returns True if a BLE FTMS server can run here, logging the reason otherwise.
         """
         if BleakServer is None:
-            logging.error("[BLE] Bleak is not available on this platform.")
-            return
-
+            logger.error("[BLE] Bleak is not available on this platform.")
+            return False
         if platform.system() == "Windows":
-            logging.error("[BLE] FTMS server is not supported on Windows.")
+            logger.error("[BLE] FTMS server is not supported on Windows.")
+            return False
+        return True
+
+    async def start(self):
+        """
+        Initializes the BLE FTMS service and starts advertising (simulated).
+        """
+        if not self.is_supported():
             return
 
-        logging.info("[BLE] Initializing FTMS GATT service...")
+        logger.info("[BLE] Initializing FTMS GATT service...")
         FTMS_UUID = "1826"
         DATA_UUID = "2AD9"
         CONTROL_UUID = "2AD8"
@@ -215,45 +523,51 @@ class BLEServiceManager:
         if hasattr(self.control_point_characteristic, "set_write_callback"):
             self.control_point_characteristic.set_write_callback(self._on_write)
         else:
-            logging.error("[BLE] write-callback missing – notify-only mode enabled")
+            logger.error("[BLE] write-callback missing – notify-only mode enabled")
             # Still attach service for notify use
 
         service = BleakService(FTMS_UUID)
         service.add_characteristic(self.ble_characteristic)
         service.add_characteristic(self.control_point_characteristic)
-        logging.info("[BLE] FTMS GATT service ready")
+        logger.info("[BLE] FTMS GATT service ready")
 
         await asyncio.sleep(1)
-        logging.info("[BLE] (Simulated) BLE notifications active")
+        logger.info("[BLE] (Simulated) BLE notifications active")
 
     def get_notify_characteristic(self):
         return self.ble_characteristic
 
-    def _on_write(self, device: 'BLEDevice', _: 'BleakGATTCharacteristic', data: bytearray):
+    def _on_write(self, device: 'BLEDevice', _: 'BleakGATTCharacteristic', data: bytes):
         """
         Secure handler for BLE FTMS control commands.
-        Applies security checks and forwards to bike controller.
+        Validates the packet once, applies security checks and forwards (opcode, param, tail) to the bike controller.
+        Accepts bytes or bytearray, since bleak backends differ.
         """
-        if not self.security.is_authorized_mac(device.address):
-            logging.warning(f"[SECURITY] Unauthorized BLE device: {device.address}")
+        try:
+            opcode = data[0]
+            param = data[1]
+        except (IndexError, TypeError):
+            logger.warning("[SECURITY] Malformed BLE command received")
             return
-        if self.security.is_throttled(device.address):
-            logging.warning(f"[SECURITY] Rate limit exceeded: {device.address}")
+        # Canonicalize once here; the whitelist is stored lowercase
+        reason = self._check(device.address.lower(), opcode)
+        if reason == "mac":
+            logger.warning("[SECURITY] Unauthorized BLE device: %s", device.address)
             return
-        if not isinstance(data, bytearray) or len(data) < 2:
-            logging.warning("[SECURITY] Malformed BLE command received")
+        if reason == "rate":
+            logger.warning("[SECURITY] Rate limit exceeded: %s", device.address)
             return
-        opcode = data[0]
-        if not self.security.is_valid_opcode(opcode):
-            logging.warning(f"[SECURITY] Invalid opcode received: {opcode}")
+        if reason == "op":
+            logger.warning("[SECURITY] Invalid opcode received: %s", opcode)
             return
 
-        logging.debug(f"[BLE] Accepted command {list(data)} from {device.address}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[BLE] Accepted command %s from %s", list(data), device.address)
 
         try:
-            self.bike.handle_control_command(data)
+            self.bike.handle_control_command(opcode, param, bytes(data[2:]))
         except Exception as e:
-            logging.error(f"[BLE] Failed to process control command: {e}")
+            logger.error("[BLE] Failed to process control command: %s", e)
 
 
 class SecurityManager:
@@ -269,82 +583,183 @@ class SecurityManager:
         """
         Loads and validates the config file, initializing internal security state.
         """
-        import json
         try:
-            with open(self.config_path, "r") as f:
-                config = json.load(f)
+            config = get_config(self.config_path)
 
             required_keys = {"authorized_devices", "allowed_opcodes", "rate_limit_seconds"}
             if not required_keys.issubset(config.keys()):
                 missing = required_keys - config.keys()
-                logging.error(f"[SECURITY] Config missing keys: {missing}")
+                logger.error("[SECURITY] Config missing keys: %s", missing)
                 return False
 
             init_security_config(config)
             self.initialized = True
-            logging.info("[SECURITY] Security config loaded successfully.")
+            logger.info("[SECURITY] Security config loaded successfully.")
             return True
 
         except Exception as e:
-            logging.error(f"[SECURITY] Failed to load config: {e}")
+            logger.error("[SECURITY] Failed to load config: %s", e)
             return False
 
-    def is_authorized_mac(self, mac: str) -> bool:
-        return is_authorized_mac(mac)
-
-    def is_valid_opcode(self, opcode: int) -> bool:
-        return is_valid_opcode(opcode)
-
-    def is_throttled(self, mac: str) -> bool:
-        return is_throttled(mac)
+    # The checks are the security_utils functions themselves, so calls skip an extra wrapper frame
+    is_authorized_mac = staticmethod(is_authorized_mac)
+    is_valid_opcode = staticmethod(is_valid_opcode)
+    is_throttled = staticmethod(is_throttled)
+    check = staticmethod(check)
 
 
 class RideLogger:
     """
     Handles CSV logging of ride metrics such as power, cadence, speed, and incline.
+    Rows are queued by log() and written in batches by a background thread so callers never block on file I/O.
+    All fields are numeric, so rows are formatted directly instead of going through csv.writer.
+
+    With binary=True, rows are stored as fixed-size BINARY_RECORD structs instead of CSV text
+    (timestamp, power, cadence, speed, incline in tenths of a percent); decode them with decode_ride_log.
     """
 
-    def __init__(self, log_path: str = "ride_log.csv"):
-        self.log_path = log_path
+    BATCH_ROWS = 64        # Write once this many rows are pending...
+    BATCH_SECONDS = 1.0    # ...or once the oldest pending row is this old
+    BINARY_RECORD = BINARY_RECORD
+
+    def __init__(self, log_path: str = None, binary: bool = False):
+        self.binary = binary
+        self.log_path = log_path or ("ride_log.bin" if binary else "ride_log.csv")
+        self._fh = None
+        self._fd = None
+        self._record_buf = bytearray(self.BATCH_ROWS * self.BINARY_RECORD.size) if binary else None
         self._initialize_log_file()
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._drain, name="ride-logger", daemon=True)
+        self._thread.start()
+        # Make sure pending rows reach disk even if the owner never calls close()
+        atexit.register(self.close)
 
     def _initialize_log_file(self):
         """
-        Creates the log file with headers if it doesn't already exist.
+        Opens the log for appending, without atime updates where the OS allows it, and writes
+        the CSV header if the file is new. Binary logs have no header.
         """
-        if not os.path.exists(self.log_path):
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | _O_BINARY
+        try:
             try:
-                with open(self.log_path, "w", newline="") as csvfile:
-                    writer = csv.writer(csvfile)
-                    writer.writerow(["timestamp", "power", "cadence", "speed", "incline"])
-                logging.info(f"[LOGGER] Created new ride log at: {self.log_path}")
-            except Exception as e:
-                logging.error(f"[LOGGER] Failed to create log file: {e}")
+                fd = os.open(self.log_path, flags | _O_NOATIME, 0o644)
+            except PermissionError:
+                # O_NOATIME is only permitted to the file's owner
+                fd = os.open(self.log_path, flags, 0o644)
+            try:
+                self._fh = os.fdopen(fd, "ab", buffering=64 * 1024)
+            except Exception:
+                os.close(fd)
+                raise
+            self._fd = fd
+            if not self.binary and os.fstat(fd).st_size == 0:
+                self._fh.write(_CSV_HEADER.encode("ascii"))
+                self._fh.flush()
+                logger.info("[LOGGER] Created new ride log at: %s", self.log_path)
+        except Exception as e:
+            logger.error("[LOGGER] Failed to open log file: %s", e)
+
+    def _drop_cache(self):
+        """
+        Tells the kernel the written log pages won't be read back, so a long ride doesn't crowd the page cache.
+        """
+        if hasattr(os, "posix_fadvise"):
+            try:
+                os.posix_fadvise(self._fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            except OSError:
+                pass
 
     def log(self, power: int, cadence: int, speed: float, incline: float):
         """
-        Logs a new entry to the CSV file.
+        Queues a new entry for the log file.
         """
-        try:
-            with open(self.log_path, "a", newline="") as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow([time.time(), power, cadence, speed, incline])
-            logging.debug(f"[LOGGER] Logged data: {power}W, {cadence}rpm, {speed}kph, {incline}%")
-        except Exception as e:
-            logging.error(f"[LOGGER] Failed to write to log: {e}")
+        self._queue.put((time.time(), power, cadence, speed, incline))
+
+    def _drain(self):
+        """
+        Background loop batching queued rows until the None sentinel is received.
+        """
+        rows = []
+        deadline = None  # When the oldest pending row has waited BATCH_SECONDS
+        while True:
+            timeout = self.BATCH_SECONDS if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                row = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                row = ()
+            if row is None:
+                break
+            if row:
+                if not rows:
+                    deadline = time.monotonic() + self.BATCH_SECONDS
+                rows.append(row)
+            if len(rows) >= self.BATCH_ROWS or (rows and time.monotonic() >= deadline):
+                self._write_rows(rows)
+                deadline = None
+        self._write_rows(rows)
+
+    def _write_rows(self, rows):
+        """
+        Writes and flushes a batch of rows, then empties the batch.
+        """
+        if rows and self._fh is not None:
+            try:
+                if self.binary:
+                    self._fh.write(self._pack_records(rows))
+                else:
+                    self._fh.write("".join(
+                        f"{timestamp},{power},{cadence},{speed:.1f},{incline}\r\n"
+                        for timestamp, power, cadence, speed, incline in rows
+                    ).encode("ascii"))
+                self._fh.flush()
+                self._drop_cache()
+            except Exception as e:
+                logger.error("[LOGGER] Failed to write to log: %s", e)
+        rows.clear()
+
+    def _pack_records(self, rows):
+        """
+        Packs a batch of rows into the reusable record buffer and returns a view of the filled part.
+        """
+        buf = self._record_buf
+        size = self.BINARY_RECORD.size
+        offset = 0
+        for timestamp, power, cadence, speed, incline in rows:
+            self.BINARY_RECORD.pack_into(buf, offset, timestamp, power, cadence, speed, int(round(incline * 10)))
+            offset += size
+        return memoryview(buf)[:offset]
+
+    def close(self):
+        """
+        Flushes pending rows, stops the writer thread and closes the log file. Safe to call more than once.
+        """
+        atexit.unregister(self.close)
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+            self._fd = None
 
 
 class AntPlusReceiver:
     """
     Manages the ANT+ communication setup and receives broadcast data from the FE-C device.
+    Broadcasts are queued by the openant thread and handed to on_data_callback by drain() on the event loop,
+    so slow processing never blocks ANT+ reception.
     """
 
-    def __init__(self, device_type: int, serial_port: str, on_data_callback):
+    QUEUE_SIZE = 256  # Packets buffered before new ones are dropped (~1 minute at 4 Hz)
+
+    def __init__(self, device_type: int, on_data_callback):
         self.device_type = device_type
-        self.serial_port = serial_port
         self.on_data_callback = on_data_callback
         self.node = Node()
         self.channel = None
+        self._loop = None
+        self._queue = asyncio.Queue(maxsize=self.QUEUE_SIZE)
 
     def _configure_channel(self):
         """
@@ -358,20 +773,47 @@ class AntPlusReceiver:
         self.channel.set_rf_freq(57)
         self.channel.set_id(0, 0, 0)
         self.channel.set_device_type(self.device_type)
-        self.channel.on_broadcast_data = lambda data: self.on_data_callback(data, self.serial_port)
+        self.channel.on_broadcast_data = self._on_broadcast
+
+    def _on_broadcast(self, data):
+        """
+        Runs on the openant dispatch thread: copies the frame and hands it to the event loop.
+        The bytes copy means struct decoding never sees a list or a reused buffer.
+        """
+        self._loop.call_soon_threadsafe(self._enqueue, bytes(data))
+
+    def _enqueue(self, data):
+        """
+        Queues a frame on the event loop, dropping it if processing has fallen too far behind.
+        """
+        try:
+            self._queue.put_nowait(data)
+        except asyncio.QueueFull:
+            logger.warning("[ANT+] Processing queue full, dropping packet.")
+
+    async def drain(self):
+        """
+        Feeds queued frames to on_data_callback until cancelled.
+        """
+        while True:
+            data = await self._queue.get()
+            try:
+                self.on_data_callback(data)
+            except Exception as e:
+                logger.error("[ANT+] Failed to process packet: %s", e)
 
     async def start(self):
         """
         Opens the ANT+ channel and begins listening for data.
+        The node's blocking dispatch loop runs in a worker thread so the event loop stays free.
         """
+        self._loop = asyncio.get_running_loop()
         self._configure_channel()
-        self.node.start()
         self.channel.open()
-        logging.info("[ANT+] Channel started and listening for broadcasts.")
+        logger.info("[ANT+] Channel started and listening for broadcasts.")
 
         try:
-            while True:
-                await asyncio.sleep(0.1)
+            await asyncio.to_thread(self.node.start)
         except asyncio.CancelledError:
             self.stop()
 
@@ -379,7 +821,7 @@ class AntPlusReceiver:
         """
         Closes the channel and stops the ANT+ node.
         """
-        logging.info("[ANT+] Shutting down ANT+ receiver.")
+        logger.info("[ANT+] Shutting down ANT+ receiver.")
         if self.channel:
             self.channel.close()
         self.node.stop()
@@ -392,13 +834,13 @@ class TDFBridgeApp:
 
     def __init__(self):
         self.args = self._parse_args()
-        self.security = SecurityManager(config_path=CONFIG_PATH)
+        self.security = SecurityManager(config_path=self.args.config)
         self.bike = BikeController(port=self.args.incline)
-        self.logger = RideLogger()
+        self.logger = RideLogger(binary=self.args.binary_log)
         self.ble_service = BLEServiceManager(self.bike, self.security)
         self.processor = SensorDataProcessor(
             bike_controller=self.bike,
-            log_file=self.logger.log_path,
+            ride_logger=self.logger,
             ble_characteristic=None  # Will be set after BLE starts
         )
 
@@ -410,7 +852,13 @@ class TDFBridgeApp:
         parser.add_argument("--debug", action="store_true", help="Enable debug logging")
         parser.add_argument("--config", default=CONFIG_PATH, help="Path to config.json")
         parser.add_argument("--test", action="store_true", help="Run in test mode (simulated data, no hardware needed)")
-        return parser.parse_args()
+        parser.add_argument("--binary-log", action="store_true", help="Write ride_log.bin fixed-size records instead of CSV")
+        parser.add_argument("--test-rate", type=float, default=1.0, help="Simulated packets per second in test mode")
+        parser.add_argument("--test-packets", type=int, default=10, help="Number of simulated packets in test mode")
+        args = parser.parse_args()
+        if args.test_rate <= 0:
+            parser.error("--test-rate must be positive")
+        return args
 
     def _setup_logging(self):
         logging.basicConfig(
@@ -421,67 +869,97 @@ class TDFBridgeApp:
 
     async def run(self):
         self._setup_logging()
+        self._stop = asyncio.Event()
+        self._install_signal_handlers()
 
         if not self.security.load_config():
-            logging.error("Aborting due to failed security config.")
+            logger.error("Aborting due to failed security config.")
             return
 
         if not self.bike.port and not self.args.test:
-            logging.error("No serial port detected or provided.")
+            logger.error("No serial port detected or provided.")
             return
         elif not self.bike.port and self.args.test:
-            logging.warning("[TEST MODE] No serial port detected, continuing in simulation mode.")
+            logger.warning("[TEST MODE] No serial port detected, continuing in simulation mode.")
 
 
         tasks = []
 
-        # Start BLE service if enabled and supported
-        if self.args.ble:
-            if BleakServer is None:
-                logging.error("BLE support not available.")
-            elif platform.system() == "Windows":
-                logging.error("BLE server not supported on Windows.")
-            else:
-                tasks.append(asyncio.create_task(self.ble_service.start()))
-                # Attach BLE notify characteristic to processor
-                self.processor.ble_characteristic = self.ble_service.get_notify_characteristic()
+        # Start BLE service if enabled and supported; the notify characteristic only exists once start() has run
+        if self.args.ble and self.ble_service.is_supported():
+            await self.ble_service.start()
+            self.processor.ble_characteristic = self.ble_service.get_notify_characteristic()
 
         # Start ANT+ receiver
         if not self.args.test:
             # Start ANT+ receiver only in real mode
             ant_receiver = AntPlusReceiver(
                 device_type=FE_C_DEVICE_TYPE,
-                serial_port=self.bike.port,
                 on_data_callback=self.processor.process
             )
             tasks.append(asyncio.create_task(ant_receiver.start()))
+            tasks.append(asyncio.create_task(ant_receiver.drain()))
         else:
             # TEST MODE: Simulate data instead of real ANT+ receiver
             tasks.append(asyncio.create_task(self.simulate_ant_plus_data()))
 
 
+        # Park until every task finishes or SIGINT/SIGTERM sets the stop event; no periodic wakeups
+        work = asyncio.gather(*tasks)
+        stopper = asyncio.create_task(self._stop.wait())
         try:
-            await asyncio.gather(*tasks)
-        except KeyboardInterrupt:
-            logging.info("Interrupted by user. Cleaning up...")
-            for task in tasks:
-                task.cancel()
-            await asyncio.gather(*tasks, return_exceptions=True)
-    
+            await asyncio.wait({work, stopper}, return_when=asyncio.FIRST_COMPLETED)
+            if self._stop.is_set():
+                logger.info("Interrupted by user. Cleaning up...")
+            elif work.exception() is not None:
+                logger.error("Bridge task failed: %s", work.exception())
+        finally:
+            stopper.cancel()
+            work.cancel()
+            await asyncio.gather(work, stopper, return_exceptions=True)
+            self.bike.close()
+            self.logger.close()
+
+    def _install_signal_handlers(self):
+        """
+        Routes SIGINT/SIGTERM to the stop event. Not available on Windows, where
+        Ctrl+C still cancels the run via asyncio.run().
+        """
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+
     async def simulate_ant_plus_data(self):
-        logging.info("[TEST MODE] Simulating ANT+ data packets.")
-        for i in range(10):  # Simulate 10 packets
-            fake_data = [0] * 12
+        """
+        Feeds simulated FE-C frames to the processor at --test-rate packets per second.
+        All frames are built before the loop so generation cost never shows up in the measured rate.
+        """
+        logger.info("[TEST MODE] Simulating ANT+ data packets.")
+        frames = []
+        for _ in range(self.args.test_packets):
+            fake_data = bytearray(12)
             fake_data[7] = random.randint(150, 200)   # Power
-            fake_data[8] = 0
             fake_data[10] = random.randint(80, 100)   # Cadence
             fake_data[5] = random.randint(0, 100)     # Grade low byte (0-1%)
-            fake_data[6] = 0
-            self.processor.process(fake_data)
-            await asyncio.sleep(1)  # Simulate time between packets
-        logging.info("[TEST MODE] Finished simulating ANT+ data.")
+            frames.append(bytes(fake_data))
 
+        interval = 1.0 / self.args.test_rate
+        for frame in frames:
+            self.processor.process(frame)
+            await asyncio.sleep(interval)  # Simulate time between packets
+        logger.info("[TEST MODE] Finished simulating ANT+ data.")
 
-if __name__ == "__main__":
+
+def main():
+    """
+    Console entry point: builds the app and runs it on a single asyncio event loop.
+    """
     app = TDFBridgeApp()
-    asyncio.run(app.run())
\ No newline at end of file
+    asyncio.run(app.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+import struct
+
+__all__ = ["BINARY_RECORD"]
+
+# One binary ride log row: timestamp, power, cadence, speed, incline in tenths of a percent.
+# Kept free of the ANT+/BLE/serial imports so the offline decoder runs on any machine.
+BINARY_RECORD = struct.Struct("<dHHfh")
@@ -1,11 +1,46 @@
+import threading
 import time
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+
+import orjson
+
+__all__ = [
+    "get_config",
+    "init_security_config",
+    "is_authorized_mac",
+    "is_valid_opcode",
+    "is_throttled",
+    "check",
+    "last_command_time",
+    "MAX_TRACKED_DEVICES",
+]
 
 # Global variables to hold security settings
-# These will be initialized at runtime using values from config.json
-AUTHORIZED_DEVICES = set()        # Stores allowed BLE MAC addresses
-ALLOWED_OPCODES = set()           # Stores allowed BLE opcodes
-RATE_LIMIT_SECONDS = 1.5          # Cooldown period between allowed commands per device
-last_command_time = {}            # Tracks the last time a device sent a command
+# These will be initialized at runtime using values from config.json; importing this module does no I/O
+AUTHORIZED_DEVICES: frozenset = frozenset()  # Stores allowed BLE MAC addresses (lowercase)
+ALLOWED_OPCODES: frozenset = frozenset()     # Stores allowed BLE opcodes
+RATE_LIMIT_SECONDS: float = 1.5              # Cooldown period between allowed commands per device
+_RATE_LIMIT_NS = int(RATE_LIMIT_SECONDS * 1e9)  # Same cooldown in integer nanoseconds for the hot path
+_initialized = False                         # Set once init_security_config() has run
+MAX_TRACKED_DEVICES = 4096        # Upper bound on devices remembered by the rate limiter
+last_command_time = OrderedDict() # Tracks the last time a device sent a command, oldest first
+_throttle_lock = threading.Lock() # BLE writes may arrive from several threads
+
+
+@lru_cache(maxsize=1)
+def get_config(path="config.json"):
+    """
+    Loads and parses the JSON config file, caching the result so every caller shares one dict.
+
+    Args:
+        path (str): Path to the config file.
+
+    Returns:
+        dict: Parsed configuration. Treat it as read-only, it is shared between callers.
+    """
+    return orjson.loads(Path(path).read_bytes())
 
 
 def init_security_config(config):
@@ -18,15 +53,25 @@ def init_security_config(config):
             - "allowed_opcodes": List of allowed operation codes (integers)
             - "rate_limit_seconds": Optional float for throttling window
     """
-    global AUTHORIZED_DEVICES, ALLOWED_OPCODES, RATE_LIMIT_SECONDS
+    global AUTHORIZED_DEVICES, ALLOWED_OPCODES, RATE_LIMIT_SECONDS, _RATE_LIMIT_NS, _initialized
 
     # Populate security parameters from config or use defaults
-    AUTHORIZED_DEVICES = set(config.get("authorized_devices", []))
-    ALLOWED_OPCODES = set(config.get("allowed_opcodes", []))
+    AUTHORIZED_DEVICES = frozenset(mac.lower() for mac in config.get("authorized_devices", []))
+    ALLOWED_OPCODES = frozenset(int(op) for op in config.get("allowed_opcodes", []))
     RATE_LIMIT_SECONDS = config.get("rate_limit_seconds", 1.5)
+    _RATE_LIMIT_NS = int(RATE_LIMIT_SECONDS * 1e9)
 
     # Clear existing command timestamps to avoid conflicts with new config
     last_command_time.clear()
+    _initialized = True
+
+
+def _require_initialized():
+    """
+    Raises RuntimeError if security checks are used before init_security_config().
+    """
+    if not _initialized:
+        raise RuntimeError("security not initialised")
 
 
 def is_authorized_mac(mac_address):
@@ -38,8 +83,12 @@ def is_authorized_mac(mac_address):
 
     Returns:
         bool: True if authorized, False otherwise.
+
+    Raises:
+        RuntimeError: If init_security_config() has not been called.
     """
-    return mac_address in AUTHORIZED_DEVICES
+    _require_initialized()
+    return mac_address.lower() in AUTHORIZED_DEVICES
 
 
 def is_valid_opcode(opcode):
@@ -51,7 +100,11 @@ def is_valid_opcode(opcode):
 
     Returns:
         bool: True if allowed, False otherwise.
+
+    Raises:
+        RuntimeError: If init_security_config() has not been called.
     """
+    _require_initialized()
     return opcode in ALLOWED_OPCODES
 
 
@@ -59,18 +112,52 @@ def is_throttled(mac):
     """
     Implements rate limiting per device.
 
+    Uses the monotonic clock in integer nanoseconds so wall-clock adjustments cannot wedge throttling, and
+    forgets the least recently seen device once MAX_TRACKED_DEVICES is exceeded.
+
     Args:
         mac (str): MAC address of the sending device.
 
     Returns:
         bool: True if the device is sending commands too frequently, False otherwise.
     """
-    now = time.time()
+    now = time.monotonic_ns()
+
+    with _throttle_lock:
+        # Check if the device has sent a command recently
+        prev = last_command_time.get(mac)
+        if prev is not None and now - prev < _RATE_LIMIT_NS:
+            last_command_time.move_to_end(mac)
+            return True
+
+        # Update last command time
+        last_command_time[mac] = now
+        last_command_time.move_to_end(mac)
+        if len(last_command_time) > MAX_TRACKED_DEVICES:
+            last_command_time.popitem(last=False)
+        return False
 
-    # Check if the device has sent a command recently
-    if mac in last_command_time and now - last_command_time[mac] < RATE_LIMIT_SECONDS:
-        return True
 
-    # Update last command time
-    last_command_time[mac] = now
-    return False
+def check(mac, opcode):
+    """
+    Runs all BLE write checks in one call: MAC whitelist, rate limit, then opcode filter.
+    This is the hot path, so it does no case folding; callers canonicalize the address once.
+
+    Args:
+        mac (str): Lowercase MAC address of the sending device.
+        opcode (int): BLE operation code from the client.
+
+    Returns:
+        str | None: "mac", "rate" or "op" naming the failed check, or None if the command is allowed.
+
+    Raises:
+        RuntimeError: If init_security_config() has not been called.
+    """
+    _require_initialized()
+    if mac not in AUTHORIZED_DEVICES:
+        return "mac"
+    if is_throttled(mac):
+        return "rate"
+    if opcode not in ALLOWED_OPCODES:
+        return "op"
+    return None
@@ -1,18 +1,35 @@
 import unittest
+import asyncio
+import threading
 from unittest.mock import patch, MagicMock
 import time
-from main import BikeController, SensorDataProcessor
-from security_utils import (
+import os
+import csv
+import tempfile
+import serial
+from tdf_data_bridge import security_utils
+from tdf_data_bridge.decode_ride_log import read_binary_log
+from tdf_data_bridge.main import (
+    AntPlusReceiver,
+    BikeController,
+    BLEServiceManager,
+    SecurityManager,
+    SensorDataProcessor,
+    RideLogger,
+    auto_detect_serial_port,
+    invalidate_serial_port_cache,
+)
+from tdf_data_bridge.security_utils import (
     is_authorized_mac,
     is_valid_opcode,
     is_throttled,
     init_security_config,
-    last_command_time
+    get_config,
+    check,
+    last_command_time,
+    MAX_TRACKED_DEVICES
 )
 
-bike = BikeController(port="/dev/ttyUSB0")
-processor = SensorDataProcessor(bike_controller=bike)
-
 class TestBikeCommands(unittest.TestCase):
 
     def setUp(self):
@@ -24,39 +41,321 @@ class TestBikeCommands(unittest.TestCase):
         }
         init_security_config(test_config)
 
-    @patch("serial.Serial")
-    def test_send_incline_valid(self, mock_serial):
-        # If using BikeController: bike = BikeController(port="/dev/ttyUSB0"); bike.send_incline(5)
-        mock_instance = MagicMock()
-        mock_serial.return_value.__enter__.return_value = mock_instance
-        bike.send_incline(5)
-        mock_instance.write.assert_called_once()
-
-    @patch("serial.Serial")
-    def test_send_incline_invalid_range(self, mock_serial):
-        bike.send_incline(50) # Invalid incline value
-        mock_serial.assert_not_called()
-
-    @patch("serial.Serial")
-    def test_send_resistance_command(self, mock_serial):
-        mock_instance = MagicMock()
-        mock_serial.return_value.__enter__.return_value = mock_instance
-        bike.send_resistance(15)      
-        mock_instance.write.assert_called_once()
-
-    @patch("serial.Serial")
-    def test_send_gear(self, mock_serial):
-        mock_instance = MagicMock()
-        mock_serial.return_value.__enter__.return_value = mock_instance
-        bike.send_gear(2, 5)
-
-        mock_instance.write.assert_called_once()
+        # One serial.Serial patch per test, shared by every serial-facing test
+        self._serial_patcher = patch("serial.Serial")
+        self.mock_serial = self._serial_patcher.start()
+        self.addCleanup(self._serial_patcher.stop)
+        self.bike = BikeController(port="/dev/ttyUSB0")
+        self.addCleanup(self.bike.close)
+        self.processor = SensorDataProcessor(bike_controller=self.bike, ride_logger=MagicMock())
+
+    def test_send_incline_valid(self):
+        self.bike.send_incline(5)
+        self.bike.flush()
+        self.mock_serial.return_value.write.assert_called_once_with(b"G+05\r\n")
+
+    def test_send_incline_invalid_range(self):
+        self.bike.send_incline(50) # Invalid incline value
+        self.bike.flush()
+        self.mock_serial.assert_not_called()
+
+    def test_send_resistance_command(self):
+        self.bike.send_resistance(15)
+        self.bike.flush()
+        self.mock_serial.return_value.write.assert_called_once_with(b"R15\r\n")
+
+    def test_send_gear(self):
+        self.bike.send_gear(2, 5)
+        self.bike.flush()
+        self.mock_serial.return_value.write.assert_called_once_with(b"G25\r\n")
+
+    def test_send_negative_incline(self):
+        self.bike.send_incline(-3)
+        self.bike.flush()
+        self.mock_serial.return_value.write.assert_called_once_with(b"G-03\r\n")
+
+    def test_duplicate_commands_are_skipped(self):
+        self.bike.send_incline(5)
+        self.bike.flush()
+        self.bike.send_incline(5.3)   # Rounds to the same command
+        self.bike.send_incline(5.6)   # Rounds to 6, a new command
+        self.bike.send_resistance(12)
+        self.bike.send_resistance(12)
+        self.bike.send_gear(2, 5)
+        self.bike.send_gear(2, 5)
+        self.bike.flush()
+        sent = b"".join(c.args[0] for c in self.mock_serial.return_value.write.call_args_list)
+        self.assertEqual(sent, b"G+05\r\nG+06\r\nR12\r\nG25\r\n")
+
+    def _block_first_write(self):
+        """
+        Makes the mocked port's first write() block until release is set; returns (writing, release).
+        """
+        writing, release = threading.Event(), threading.Event()
+        def write(cmd):
+            writing.set()
+            release.wait(1)
+        self.mock_serial.return_value.write.side_effect = write
+        return writing, release
+
+    def test_pending_incline_is_latest_wins(self):
+        writing, release = self._block_first_write()
+        self.bike.send_resistance(10)
+        writing.wait(1)                # Writer is now stuck inside write()
+        self.bike.send_incline(1)
+        self.bike.send_incline(2)
+        self.bike.send_incline(3)      # Replaces the still-pending grades
+        release.set()
+        self.bike.flush()
+        sent = [c.args[0] for c in self.mock_serial.return_value.write.call_args_list]
+        self.assertEqual(sent, [b"R10\r\n", b"G+03\r\n"])
+
+    def test_newer_incline_survives_failed_enqueue(self):
+        enqueue = self.bike._enqueue
+        def full_queue(item):
+            self.bike._enqueue = enqueue
+            self.bike.send_incline(5)  # Lands while the first grade's enqueue is failing
+            return False
+        self.bike._enqueue = full_queue
+        self.bike.send_incline(3)
+        self.assertIsNone(self.bike.last_sent_incline)  # Retry allowed for the dropped grade
+        self.bike.send_resistance(10)  # Wakes the writer, which also picks up the orphaned grade
+        self.bike.flush()
+        sent = b"".join(c.args[0] for c in self.mock_serial.return_value.write.call_args_list)
+        self.assertEqual(sent, b"R10\r\nG+05\r\n")
+
+    def test_gear_unchanged_when_queue_is_full(self):
+        with patch.object(self.bike, "_enqueue", return_value=False):
+            self.bike.send_gear(2, 5)
+        self.assertEqual(self.bike.current_gear, b"\x01\x01")
+        self.assertIsNone(self.bike.last_sent_gear)
+
+    def test_queued_commands_share_one_write(self):
+        writing, release = self._block_first_write()
+        self.bike.send_incline(2)
+        writing.wait(1)
+        self.bike.send_resistance(12)
+        self.bike.send_gear(2, 5)
+        release.set()
+        self.bike.flush()
+        sent = [c.args[0] for c in self.mock_serial.return_value.write.call_args_list]
+        self.assertEqual(sent, [b"G+02\r\n", b"R12\r\nG25\r\n"])
+
+    def test_serial_port_is_reused(self):
+        self.bike.send_resistance(10)
+        self.bike.send_gear(2, 5)
+        self.bike.flush()
+        self.mock_serial.assert_called_once()  # Port opened once for both commands
+        self.assertEqual(self.mock_serial.call_args.kwargs["write_timeout"], 0.05)
+        self.mock_serial.return_value.set_low_latency_mode.assert_called_once_with(True)
+        sent = b"".join(c.args[0] for c in self.mock_serial.return_value.write.call_args_list)
+        self.assertEqual(sent, b"R10\r\nG25\r\n")
+        self.bike.close()
+        self.mock_serial.return_value.close.assert_called_once()
+
+    @patch("tdf_data_bridge.main.platform.system", return_value="Linux")
+    @patch("tdf_data_bridge.main.glob.glob", return_value=["/sys/bus/usb-serial/drivers/cp210x/ttyUSB3"])
+    @patch("serial.tools.list_ports.comports")
+    def test_auto_detect_uses_cp210x_sysfs(self, mock_comports, _mock_glob, _mock_system):
+        invalidate_serial_port_cache()
+        self.assertEqual(auto_detect_serial_port(), "/dev/ttyUSB3")
+        mock_comports.assert_not_called()
+        invalidate_serial_port_cache()
+
+    @patch("tdf_data_bridge.main.glob.glob", return_value=[])
+    @patch("serial.tools.list_ports.comports")
+    def test_auto_detect_serial_port_is_cached(self, mock_comports, _mock_glob):
+        mock_comports.return_value = [MagicMock(description="CP2102 USB to UART", device="/dev/ttyUSB1")]
+        invalidate_serial_port_cache()
+        self.assertEqual(auto_detect_serial_port(), "/dev/ttyUSB1")
+        bike = BikeController()
+        self.addCleanup(bike.close)
+        self.assertEqual(bike.port, "/dev/ttyUSB1")
+        mock_comports.assert_called_once()  # Second lookup served from cache
+        invalidate_serial_port_cache()
+
+    def test_write_timeout_keeps_port_open(self):
+        port = self.mock_serial.return_value
+        port.write.side_effect = [serial.SerialTimeoutException("slow"), None]
+        self.bike.send_resistance(12)
+        self.bike.flush()
+        port.close.assert_not_called()
+        self.bike.send_resistance(12)  # Dedup was reset, so the same level is sent again
+        self.bike.flush()
+        self.mock_serial.assert_called_once()  # Same port object reused
+        self.assertEqual(port.write.call_count, 2)
+
+    @patch("tdf_data_bridge.main.platform.system", return_value="Linux")
+    @patch("tdf_data_bridge.main.glob.glob")
+    @patch("serial.tools.list_ports.comports", return_value=[])
+    def test_serial_error_redetects_port_on_next_open(self, _mock_comports, mock_glob, _mock_system):
+        invalidate_serial_port_cache()
+        self.addCleanup(invalidate_serial_port_cache)
+        mock_glob.return_value = ["/sys/bus/usb-serial/drivers/cp210x/ttyUSB0"]
+        bike = BikeController()
+        self.addCleanup(bike.close)
+        self.mock_serial.return_value.write.side_effect = [
+            serial.SerialException("unplugged"), serial.SerialException("unplugged"), None,
+        ]
+        mock_glob.return_value = []    # Adapter briefly missing
+        bike.send_resistance(10)
+        bike.flush()
+        self.assertEqual(bike.port, "/dev/ttyUSB0")  # No replacement found, so the old port is kept
+        bike.send_resistance(10)       # Retried on the old port; detection still finds nothing
+        bike.flush()
+        mock_glob.return_value = ["/sys/bus/usb-serial/drivers/cp210x/ttyUSB1"]
+        bike.send_resistance(10)
+        bike.flush()
+        self.assertEqual(bike.port, "/dev/ttyUSB1")
+        self.assertEqual(self.mock_serial.call_args.args[0], "/dev/ttyUSB1")
 
     def test_estimate_speed_from_cadence(self):
-        speed = processor.estimate_speed_from_cadence(90)
+        speed = self.processor.estimate_speed_from_cadence(90)
         self.assertGreater(speed, 0)
         self.assertIsInstance(speed, float)
 
+    def test_process_decodes_fec_frame(self):
+        bike_mock = MagicMock()
+        logger_mock = MagicMock()
+        proc = SensorDataProcessor(bike_controller=bike_mock, ride_logger=logger_mock)
+        frame = bytearray(12)
+        frame[5:7] = (550).to_bytes(2, "little")   # 5.5% grade
+        frame[7:9] = (260).to_bytes(2, "little")   # 260 W
+        frame[10] = 90                             # 90 rpm
+        proc.process(bytes(frame))
+        bike_mock.send_incline.assert_called_once_with(6)
+        power, cadence, _, incline = logger_mock.log.call_args[0]
+        self.assertEqual((power, cadence, incline), (260, 90, 6))
+
+    def test_process_skips_repeated_frame(self):
+        frame = bytearray(12)
+        frame[5:7] = (300).to_bytes(2, "little")
+        frame[7:9] = (200).to_bytes(2, "little")
+        frame[10] = 85
+        with patch.object(self.processor, "_notify_ble") as mock_notify, \
+                patch.object(self.bike, "send_incline", wraps=self.bike.send_incline) as mock_send:
+            self.bike.last_sent_incline = 3  # The bike already has this grade
+            self.processor.process(bytes(frame))
+            self.processor.process(bytes(frame))
+            self.bike.send_gear(2, 5)       # A gear change alone still renotifies
+            self.processor.process(bytes(frame))
+            self.processor.current_resistance = 11  # So does a resistance change
+            self.processor.process(bytes(frame))
+            self.processor._notified_at -= SensorDataProcessor.NOTIFY_INTERVAL  # Last notify is now a second old
+            self.processor.process(bytes(frame))
+        mock_send.assert_not_called()
+        self.assertEqual(mock_notify.call_count, 4)
+        self.assertEqual(self.processor.ride_logger.log.call_count, 5)  # Every packet is still logged
+
+    def test_process_decodes_negative_grade(self):
+        bike_mock = MagicMock()
+        proc = SensorDataProcessor(bike_controller=bike_mock, ride_logger=MagicMock())
+        frame = bytearray(12)
+        frame[5:7] = (-800).to_bytes(2, "little", signed=True)  # -8% grade, softened to -4
+        proc.process(bytes(frame))
+        bike_mock.send_incline.assert_called_once_with(-4)
+
+    def test_process_clamps_steep_grade(self):
+        bike_mock = MagicMock()
+        proc = SensorDataProcessor(bike_controller=bike_mock, ride_logger=MagicMock())
+        frame = bytearray(12)
+        frame[5:7] = (6000).to_bytes(2, "little")  # 60% grade, beyond the lookup table
+        proc.process(bytes(frame))
+        bike_mock.send_incline.assert_called_once_with(20)
+
+    @patch("tdf_data_bridge.main.Node")
+    def test_ant_broadcasts_are_processed_on_event_loop(self, _mock_node):
+        received = []
+
+        def on_data(data):
+            received.append(data)
+
+        async def scenario():
+            receiver = AntPlusReceiver(device_type=17, on_data_callback=on_data)
+            receiver._loop = asyncio.get_running_loop()
+            drain = asyncio.create_task(receiver.drain())
+            # Simulate the openant dispatch thread delivering a list payload
+            sender = threading.Thread(target=receiver._on_broadcast, args=([1, 2, 3],))
+            sender.start()
+            sender.join()
+            while not received:
+                await asyncio.sleep(0.01)
+            drain.cancel()
+
+        asyncio.run(asyncio.wait_for(scenario(), timeout=2))
+        self.assertEqual(received, [b"\x01\x02\x03"])
+
+    def test_notify_ble_payload(self):
+        characteristic = MagicMock()
+        characteristic.properties = ["notify"]
+        self.processor.ble_characteristic = characteristic
+        self.processor._notify_ble(180, 90, 13.5, -2)
+        payload = bytes(characteristic.value)
+        self.assertEqual(len(payload), 14)
+        self.assertEqual(payload[:2], (0x03FF).to_bytes(2, "little"))
+        self.assertEqual(payload[2:4], (1350).to_bytes(2, "little"))
+        self.assertEqual(payload[6:8], (180).to_bytes(2, "little"))
+        self.assertEqual(payload[8:10], (-20).to_bytes(2, "little", signed=True))
+        self.assertEqual(payload[12:], b"\x01\x01")
+        first = characteristic.value
+        self.processor._notify_ble(200, 95, 14.3, 3)
+        self.assertEqual(bytes(first), payload)  # Earlier value isn't touched by the next notify
+        self.assertIsNot(characteristic.value, first)
+
+    def test_notify_skipped_without_notify_property(self):
+        characteristic = MagicMock(properties=["read"], value=b"\x00")
+        self.processor.ble_characteristic = characteristic
+        self.processor._notify_ble(180, 90, 13.5, -2)
+        self.assertEqual(characteristic.value, b"\x00")
+
+    def test_ride_logger_writes_queued_rows(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ride_log.csv")
+            logger = RideLogger(log_path=path)
+            logger.log(180, 90, 13.5, 2)
+            logger.log(190, 92, 13.8, 3)
+            logger.close()  # Flushes the background writer
+            with open(path, newline="") as f:
+                rows = list(csv.reader(f))
+        self.assertEqual(rows[0], ["timestamp", "power", "cadence", "speed", "incline"])
+        self.assertEqual(rows[1][1:], ["180", "90", "13.5", "2"])
+        self.assertEqual(len(rows), 3)
+
+    def test_ride_logger_closes_fd_when_fdopen_fails(self):
+        with tempfile.TemporaryDirectory() as tmp, \
+                patch("tdf_data_bridge.main.os.fdopen", side_effect=OSError("no buffer")), \
+                patch("tdf_data_bridge.main.os.close", wraps=os.close) as mock_close:
+            logger = RideLogger(log_path=os.path.join(tmp, "ride_log.csv"))
+            logger.close()
+        mock_close.assert_called_once()  # The raw descriptor isn't leaked
+        self.assertIsNone(logger._fh)
+
+    def test_ride_logger_flushes_oldest_row_on_time(self):
+        with tempfile.TemporaryDirectory() as tmp, patch.object(RideLogger, "BATCH_SECONDS", 0.05):
+            path = os.path.join(tmp, "ride_log.csv")
+            logger = RideLogger(log_path=path)
+            self.addCleanup(logger.close)
+            logger.log(180, 90, 13.5, 2)
+            for _ in range(100):           # Written well before close(), once the row is BATCH_SECONDS old
+                with open(path) as f:
+                    if len(f.read().splitlines()) == 2:
+                        break
+                time.sleep(0.01)
+            else:
+                self.fail("pending row was not written after BATCH_SECONDS")
+            logger.close()
+
+    def test_binary_ride_log_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ride_log.bin")
+            logger = RideLogger(log_path=path, binary=True)
+            logger.log(180, 90, 13.5, -2)
+            logger.log(190, 92, 13.75, 3)
+            logger.close()
+            self.assertEqual(os.path.getsize(path), 2 * RideLogger.BINARY_RECORD.size)
+            rows = read_binary_log(path)
+        self.assertEqual([row[1:] for row in rows], [(180, 90, 13.5, -2.0), (190, 92, 13.75, 3.0)])
+
     def test_mac_authorization(self):
         self.assertTrue(is_authorized_mac("00:11:22:33:44:55"))
         self.assertFalse(is_authorized_mac("DE:AD:BE:EF:00:00"))
@@ -65,6 +364,25 @@ class TestBikeCommands(unittest.TestCase):
         self.assertTrue(is_valid_opcode(0x05))
         self.assertFalse(is_valid_opcode(0x99))
 
+    def test_mac_authorization_ignores_case(self):
+        init_security_config({"authorized_devices": ["aa:bb:cc:dd:ee:ff"], "allowed_opcodes": [0x05]})
+        self.assertTrue(is_authorized_mac("AA:BB:CC:DD:EE:FF"))
+
+    def test_checks_fail_before_init(self):
+        with patch.object(security_utils, "_initialized", False):
+            with self.assertRaises(RuntimeError):
+                is_authorized_mac("00:11:22:33:44:55")
+            with self.assertRaises(RuntimeError):
+                is_valid_opcode(0x05)
+
+    def test_combined_check(self):
+        last_command_time.clear()
+        self.assertEqual(check("DE:AD:BE:EF:00:00", 0x05), "mac")
+        self.assertEqual(check("00:11:22:33:44:55", 0x99), "op")
+        self.assertEqual(check("00:11:22:33:44:55", 0x05), "rate")  # Previous call started the cooldown
+        last_command_time.clear()
+        self.assertIsNone(check("00:11:22:33:44:55", 0x05))
+
     def test_reject_invalid_mac(self):
         device = MagicMock()
         device.address = "DE:AD:BE:EF:00:00"
@@ -77,6 +395,33 @@ class TestBikeCommands(unittest.TestCase):
         result = "rejected" if not is_valid_opcode(data[0]) else "accepted"
         self.assertEqual(result, "rejected")
 
+    def test_on_write_forwards_parsed_command(self):
+        last_command_time.clear()
+        bike_mock = MagicMock()
+        service = BLEServiceManager(bike_mock, SecurityManager())
+        device = MagicMock(address="00:11:22:33:44:55")
+        service._on_write(device, None, bytes([0x05, 7, 1]))  # bytes as well as bytearray
+        bike_mock.handle_control_command.assert_called_once_with(0x05, 7, b"\x01")
+
+    def test_on_write_folds_mac_case(self):
+        init_security_config({"authorized_devices": ["AA:BB:CC:DD:EE:FF"], "allowed_opcodes": [0x05]})
+        bike_mock = MagicMock()
+        service = BLEServiceManager(bike_mock, SecurityManager())
+        service._on_write(MagicMock(address="aA:Bb:cC:dD:eE:fF"), None, bytearray([0x05, 1]))
+        bike_mock.handle_control_command.assert_called_once()
+
+    def test_on_write_rejects_short_packet(self):
+        bike_mock = MagicMock()
+        service = BLEServiceManager(bike_mock, SecurityManager())
+        service._on_write(MagicMock(address="00:11:22:33:44:55"), None, bytearray([0x05]))
+        bike_mock.handle_control_command.assert_not_called()
+
+    def test_handle_gear_control_command(self):
+        self.bike.handle_control_command(0x40, 2, b"\x05")
+        self.bike.flush()
+        self.mock_serial.return_value.write.assert_called_once_with(b"G25\r\n")
+        self.assertEqual(self.processor.current_gear, b"\x02\x05")  # Processor sees the new gear
+
     def test_ble_command_rate_limit(self):
         mac = "00:11:22:33:44:55"
         last_command_time.clear()
@@ -85,5 +430,24 @@ class TestBikeCommands(unittest.TestCase):
         time.sleep(1.1)                      # Wait for cooldown (slightly more than 1 sec)
         self.assertFalse(is_throttled(mac))  # Command allowed after cooldown
 
+    def test_rate_limit_tracking_is_bounded(self):
+        last_command_time.clear()
+        for i in range(MAX_TRACKED_DEVICES + 10):
+            is_throttled(f"device-{i}")
+        self.assertEqual(len(last_command_time), MAX_TRACKED_DEVICES)
+        self.assertNotIn("device-0", last_command_time)  # Oldest entries are evicted first
+        last_command_time.clear()
+
+    def test_get_config_is_cached(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "config.json")
+            with open(path, "w") as f:
+                f.write('{"authorized_devices": [], "allowed_opcodes": [5], "rate_limit_seconds": 1}')
+            get_config.cache_clear()
+            first = get_config(path)
+            self.assertEqual(first["allowed_opcodes"], [5])
+            self.assertIs(get_config(path), first)  # Second call reuses the parsed dict
+        get_config.cache_clear()
+
 if __name__ == '__main__':
     unittest.main()